@@ -1,23 +1,44 @@
 import datetime
+import functools
+import html
 import yaml
-import re
 import smtplib
 import sqlite3
 import os
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from tabulate import tabulate
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from email.message import EmailMessage
 from decouple import config
 
+try:
+    import re2 as re
+except ImportError:
+    import re
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 # Default values
 NUMBER_OF_DAYS = int(config('NUMBER_OF_DAYS_BEFORE'))
 DAYS_FOR_CODE = int(config('DAYS_FOR_CODE_IN_BASE'))
 INVENTORY = config('INVENTORY')
 EXCEPTIONS = config('EXCEPTIONS')
 DB_NAME = config('DB_NAME')
-SCHEMA_FILE_NAME = config('SCHEMA_FILE_NAME')
 PATH_TO_LOG_FILES = config('PATH_TO_LOG_FILES')
+TEMPLATE = 'template.html'
+CHUNK_SIZE = 1 << 20
+# ProcessPoolExecutor on Windows doesn't accept more than 61 workers
+MAX_WORKERS = 61
+BUFFER_SIZE = 1 << 17
+# WAL blocks nothing here: this script is the only writer of the db
+PRAGMAS = """PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-20000;"""
 REGEX = re.compile(r'^\S+\s+\S+\s+(?P<level>\w+.\w+)\s+.+\s+(?P<code>%\w+-\d-\w+):\s+(?P<message>.+)')
+CREATE_TABLE_QUERY = 'CREATE table if not exists "{}" (code text not NULL primary key, last_active datetime);\n'
+USE_REGEX_PARSER = config('USE_REGEX_PARSER', default=False, cast=bool)
 SERVER = config('SERVER')
 FROM = config('FROM')
 TO = config('TO')
@@ -33,6 +54,29 @@ def get_data(days):
     return datetime.date.today() - datetime.timedelta(days=days)
 
 
+def load_yaml(filename):
+    """
+    Parse YAML-file
+    Args:
+        filename: name of YAML-file (str)
+    Returns: parsed YAML-file content
+    """
+    with open(filename) as file:
+        return yaml.load(file, Loader=SafeLoader)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_exceptions(filename, mtime):
+    """
+    Parse exceptions YAML-file into set of codes. Cached by file name and modification time
+    Args:
+        filename: name of YAML-file (str)
+        mtime: modification time of YAML-file (float)
+    Returns: exception codes (frozenset)
+    """
+    return frozenset(load_yaml(filename) or ())
+
+
 def open_inventory(filename):
     """
     Open YAML-file, get inventory from there and close
@@ -40,39 +84,34 @@ def open_inventory(filename):
         filename: name of YAML-file
     Returns: inventory (dict)
     """
-    with open(filename) as file:
-        inv = yaml.safe_load(file.read())
+    inv = load_yaml(filename)
+    for devices in inv.values():
+        for device in devices:
+            ip1, ip2, ip3, ip4 = device['ip'].split('.')
+            device['ip_padded'] = f"{int(ip1):>03}.{int(ip2):>03}.{int(ip3):>03}.{int(ip4):>03}"
     return inv
 
 
-def create_schema(inv, name):
+def build_schema(inv):
     """
-    Create schema file from inventory dict
+    Build db schema from inventory dict
     Args:
         inv: inventory (dict)
-        name: name of schema file (str)
-    Returns: nothing, just create file
+    Returns: schema (str)
     """
-    temp = str()
-    with open(name, 'w') as file:
-        for devices in inv.values():
-            for device in devices:
-                device_name = device['name'].replace('-', '_')
-                temp += f"""CREATE table "{device_name}" (code text not NULL primary key, last_active datetime);\n"""
-        file.write(temp)
+    return ''.join(CREATE_TABLE_QUERY.format(device['name'].replace('-', '_'))
+                   for devices in inv.values() for device in devices)
 
 
-def format_file_name(device_ip, date):
+def format_file_name(device, date):
     """
     Get template for name of syslog file
     Args:
-        device_ip: device ip (str)
+        device: device from inventory with zero-padded ip (dict)
         date: date (class obj)
     Returns: template as date.device_ip.txt (str)
     """
-    ip1, ip2, ip3, ip4 = device_ip.split('.')
-    template = f"{date}.{int(ip1):>03}.{int(ip2):>03}.{int(ip3):>03}.{int(ip4):>03}.txt"
-    return template
+    return f"{date}.{device['ip_padded']}.txt"
 
 
 def exception(result):
@@ -82,65 +121,211 @@ def exception(result):
         result: (dict)
     Returns: nothing, just delete exception code
     """
-    with open(EXCEPTIONS) as file:
-        exc = yaml.safe_load(file.read())
+    exc = parse_exceptions(EXCEPTIONS, os.path.getmtime(EXCEPTIONS))
     for code in list(result):
-        try:
-            if code in exc:
-                del result[code]
-        except TypeError:
-            pass
+        if code in exc:
+            del result[code]
+
+
+def read_lines(filename):
+    """
+    Read log file by big chunks and split it into lines
+    Args:
+        filename: name of log file (str)
+    Returns: generator of log lines (str)
+    """
+    tail = str()
+    # router syslog is ASCII, latin-1 decodes any byte without checks
+    with open(filename, 'r', buffering=BUFFER_SIZE, encoding='latin-1') as log:
+        while True:
+            chunk = log.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+    if tail:
+        yield tail
+
+
+def is_word(text):
+    """
+    Check that text matches \\w+ of REGEX
+    Args:
+        text: (str)
+    Returns: True if text is not empty and has only letters, digits and '_' (bool)
+    """
+    return text.replace('_', 'a').isalnum()
+
+
+@functools.lru_cache(maxsize=4096)
+def is_level(level):
+    """
+    Check message level format: str.str (\\w+.\\w+ of REGEX)
+    Args:
+        level: message level candidate (str)
+    Returns: True if level has right format (bool)
+    """
+    dot = level.find('.')
+    if 0 < dot and is_word(level[:dot]) and is_word(level[dot + 1:]):
+        return True
+    for i in range(1, len(level) - 1):
+        if is_word(level[:i]) and is_word(level[i + 1:]):
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=4096)
+def is_code(code):
+    """
+    Check message-code format: %str-number-str
+    Args:
+        code: message-code candidate (str)
+    Returns: True if code has right format (bool)
+    """
+    parts = code[1:].split('-')
+    return (len(parts) == 3 and len(parts[1]) == 1 and parts[1].isdecimal()
+            and is_word(parts[0]) and is_word(parts[2]))
 
 
-def parse_log(device, temp):
+def find_code(line, level_end):
     """
-    Parse log file in certain date (with unique message-code)
+    Find the last message-code after level, with the same rules as REGEX:
+    at least one token between level and code, whitespace before code
+    and after colon, not empty message
+    Args:
+        line: log line (str)
+        level_end: index of the end of level in line (int)
+    Returns: (code, message) tuple or None if there is no suitable code
+    """
+    idx = line.rfind('%')
+    while idx >= level_end + 3:
+        end = line.find(':', idx)
+        rest = line[end + 1:].rstrip('\n')
+        if (end != -1 and line[idx - 1].isspace() and len(rest) > 1 and rest[0].isspace()
+                and is_code(line[idx:end])):
+            return line[idx:end], rest.lstrip() or rest[-1]
+        idx = line.rfind('%', 0, idx)
+    return None
+
+
+def parse_line(line):
+    """
+    Parse log line without regex, gives the same result as parse_line_regex
+    Args:
+        line: log line (str)
+    Returns: (level, code, message) tuple or None if line has no message-code
+    """
+    head = line.split(None, 2)
+    if len(head) < 3 or line[0].isspace():
+        return None
+    start = len(line) - len(head[2])
+    field = head[2].split(None, 1)[0]
+    field_end = start + len(field)
+    levels = []
+    # REGEX tries the single whitespace after a word-only field as '.' of \\w+.\\w+ first
+    if is_word(field):
+        token = line[field_end + 1:].split(None, 1)
+        if token and not line[field_end + 1].isspace() and is_word(token[0]):
+            levels.append((line[start:field_end + 1 + len(token[0])], field_end + 1 + len(token[0])))
+    if is_level(field):
+        levels.append((field, field_end))
+    for level, level_end in levels:
+        found = find_code(line, level_end)
+        if found:
+            return (level, *found)
+    return None
+
+
+def parse_line_regex(line):
+    """
+    Parse log line with REGEX (fallback for log format drift)
+    Args:
+        line: log line (str)
+    Returns: (level, code, message) tuple or None if line has no message-code
+    """
+    match = REGEX.search(line)
+    if match:
+        return match.group('level', 'code', 'message')
+    return None
+
+
+def parse_log(temp):
+    """
+    Parse log file in certain date (with unique message-code).
+    Runs in worker process, so it doesn't touch db
     Args:
-        device: device ip-address (str)
         temp: template of log-file name (str)
     Returns: parsed result (dict)
     """
-    regex = REGEX
-    result = dict()
-    with open(temp) as log:
-        for line in log:
-            match = regex.search(line)
-            if match:
-                key = (match.group('code'))
-                if key in result:
-                    result[key][0] += 1
-                else:
-                    result[key] = [1, match.group('level'), match.group('message')]
-            else:
-                if line in result:
-                    result[line][0] += 1
-                else:
-                    result[line] = [1]
-    compared_result = compare_with_db(DB_NAME, device, result)
-    exception(compared_result)
-    return compared_result
+    parse = parse_line_regex if USE_REGEX_PARSER else parse_line
+    counts = Counter()
+    meta = dict()
+    for line in read_lines(temp):
+        # every code line contains '%', skip parsing for the rest
+        parsed = parse(line) if '%' in line else None
+        if parsed:
+            level, key, message = parsed
+            counts[key] += 1
+            meta.setdefault(key, (level, message))
+        else:
+            counts[line] += 1
+    return {key: [count, *meta[key]] if key in meta else [count] for key, count in counts.items()}
 
 
-def format_log(inventory, date):
+@functools.lru_cache(maxsize=None)
+def read_template(filename):
     """
-    Get result string of parsed log-files for sending e-mail in html format
+    Read html template once per process
+    Args:
+        filename: name of html template (str)
+    Returns: template (str)
+    """
+    with open(filename) as file:
+        return file.read()
+
+
+def rows_to_html(rows, header):
+    """
+    Get html table from rows
+    Args:
+        rows: table rows (list of lists)
+        header: column names (list)
+    Returns: html table (str)
+    """
+    head = ''.join(f'<th>{name}</th>' for name in header)
+    body = ''.join('<tr>' + ''.join(f'<td>{html.escape(str(cell))}</td>' for cell in row) + '</tr>'
+                   for row in rows)
+    return f'<table><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>'
+
+
+def format_log(inventory, date, conn):
+    """
+    Get result string of parsed log-files for sending e-mail in html format.
+    Log files are parsed in parallel, db compare is done one device at a time
     Args:
         inventory: (dict)
         date: (obj)
+        conn: db connection in autocommit mode (sqlite3.Connection)
     Returns: result html string with tables (str)
     """
-    with open('template.html') as file:
-        result_string = file.read()
-    body = str()
+    result_string = read_template(TEMPLATE)
+    body = []
     header = ['numb', 'level', 'code', 'message']
-    for device_type, devices in inventory.items():
-        for device in devices:
+    targets = [(device_type, device) for device_type, devices in inventory.items() for device in devices]
+    workers = max(1, min(len(targets), os.cpu_count() or 1, MAX_WORKERS))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = [(device_type, device,
+                 executor.submit(parse_log, PATH_TO_LOG_FILES + format_file_name(device, date)))
+                for device_type, device in targets]
+        for device_type, device, job in jobs:
             column = []
-            template = format_file_name(device['ip'], date)
             device_name = device['name'].replace('-', '_')
-            body += f"<p><big>- {device_type} {device['name']} ({device['ip']}):</big></p>"
+            body.append(f"<p><big>- {device_type} {device['name']} ({device['ip']}):</big></p>")
             try:
-                result = parse_log(device_name, PATH_TO_LOG_FILES + template)
+                result = compare_with_db(conn, device_name, job.result())
+                exception(result)
                 for code, value in result.items():
                     if len(value) == 3:
                         column.append([value[0], value[1], code, value[2]])
@@ -148,10 +333,10 @@ def format_log(inventory, date):
                         column.append([value[0], '-', '-', code])
                 column.sort(reverse=True)
             except FileNotFoundError:
-                body += f"""<p style="margin-left: 40px">{device['ip']} logfile for {str(date)} not found</p>"""
+                body.append(f"""<p style="margin-left: 40px">{device['ip']} logfile for {str(date)} not found</p>""")
             else:
-                body += tabulate(column, headers=header, tablefmt="html")
-    return result_string.format(body=body)
+                body.append(rows_to_html(column, header))
+    return result_string.format(body=''.join(body))
 
 
 def send_email(date, result):
@@ -162,64 +347,58 @@ def send_email(date, result):
         result: parsed result in html format (str)
     Returns: nothing, just send e-mail
     """
-    message = MIMEMultipart("alternative", None, [MIMEText(result, 'html')])
+    message = EmailMessage()
     message['Subject'] = f"net_syslog for {date}"
     message['From'] = FROM
     message['To'] = TO
+    message.set_content(result, subtype='html')
     with smtplib.SMTP(SERVER) as server:
-        server.sendmail(FROM, TO, message.as_string())
+        server.send_message(message)
 
 
-def create_db(db_name, schema):
+def create_db(conn, inv):
     """
-    Check if db exist or not. Create db from template if not
+    Create tables for all devices from inventory (existing tables are kept)
     Args:
-        db_name: name of db (str)
-        schema: template for db creation (str)
+        conn: db connection in autocommit mode (sqlite3.Connection)
+        inv: inventory (dict)
     Returns: nothing
     """
-    db_exist = os.path.exists(DB_NAME)
-    if not db_exist:
-        conn = sqlite3.connect(db_name)
-        with open(schema) as file:
-            conn.executescript(file.read())
-        conn.commit()
-        conn.close()
+    conn.executescript(build_schema(inv))
 
 
-def compare_with_db(db_name, device_name, result):
+def compare_with_db(conn, device_name, result):
     """
     Perform compare codes with db. Generate ATTENTION message if there is new code
     Args:
-        db_name: name of db (str)
+        conn: db connection in autocommit mode (sqlite3.Connection)
         device_name: device name (str)
         result: result dict for certain device (dict)
     Returns: compared result (dict)
     """
     now = datetime.datetime.today()
     week_ago = now - datetime.timedelta(days=DAYS_FOR_CODE)
-    select_query = f"SELECT last_active from {device_name} where code = ?"
     replace_query = f"INSERT OR REPLACE into {device_name} values (?, datetime('now', 'localtime'))"
-    with sqlite3.connect(db_name) as conn:
-        for code in result:
-            check = conn.execute(select_query, (code,))
-            check_result = check.fetchone()
-            if check_result:
-                if str(week_ago) > check_result[0]:
-                    conn.execute(replace_query, (code,))
-                    try:
-                        result[code][1] += " !!!ATTENTION!!!"
-                    except IndexError:
-                        result["!!!ATTENTION!!! " + code] = result.pop(code)
-                else:
-                    conn.execute(replace_query, (code,))
-            else:
-                conn.execute(replace_query, (code,))
-                try:
-                    result[code][1] += " !!!ATTENTION!!!"
-                except IndexError:
-                    result["!!!ATTENTION!!! " + code] = result.pop(code)
-    conn.close()
+    select_query = f"SELECT p.code, t.last_active from probe p left join {device_name} t on t.code = p.code"
+    codes = [(code,) for code in result]
+    conn.execute("BEGIN")
+    try:
+        conn.execute("CREATE temp table if not exists probe (code text not NULL primary key)")
+        conn.execute("DELETE from probe")
+        conn.executemany("INSERT into probe values (?)", codes)
+        # last_active is NULL for new codes
+        attention = [code for code, last_active in conn.execute(select_query)
+                     if last_active is None or str(week_ago) > last_active]
+        conn.executemany(replace_query, codes)
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    for code in attention:
+        try:
+            result[code][1] += " !!!ATTENTION!!!"
+        except IndexError:
+            result["!!!ATTENTION!!! " + code] = result.pop(code)
     return result
 
 
@@ -230,9 +409,13 @@ def main():
     """
     inventory = open_inventory(INVENTORY)
     date = get_data(NUMBER_OF_DAYS)
-    create_schema(inventory, SCHEMA_FILE_NAME)
-    create_db(DB_NAME, SCHEMA_FILE_NAME)
-    result = format_log(inventory, date)
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    conn.executescript(PRAGMAS)
+    try:
+        create_db(conn, inventory)
+        result = format_log(inventory, date, conn)
+    finally:
+        conn.close()
     send_email(date, result)
 
 